@@ -1,8 +1,13 @@
 import os
+import gzip
+import stat
+import asyncio
 import logging
-from datetime import timedelta
-from fastapi import APIRouter, HTTPException, BackgroundTasks, Depends
-from fastapi.responses import FileResponse, HTMLResponse
+import orjson
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+from fastapi import APIRouter, HTTPException, BackgroundTasks, Depends, Request
+from fastapi.responses import FileResponse, HTMLResponse, ORJSONResponse, Response, StreamingResponse
 
 from app.models.schemas import (
     LoginRequest,
@@ -40,12 +45,65 @@ def set_services(tg_service: TelegramService, dl_service: DownloadService, st_ma
     auth_service = a_service
 
 
+# HTML pages never change while the process runs; keep their bytes (plain and
+# gzip-compressed) in memory
+_page_cache: Dict[str, Tuple[bytes, bytes]] = {}
+
+
+def _read_html(page_name: str) -> Tuple[bytes, bytes]:
+    """Read an HTML page from disk and precompress it"""
+    with open(os.path.join('app', 'static', page_name), 'rb') as f:
+        content = f.read()
+    return content, gzip.compress(content, compresslevel=9)
+
+
+def load_pages():
+    """Load the HTML pages into memory (called once at startup)"""
+    for page_name in ('login.html', 'view.html'):
+        _page_cache[page_name] = _read_html(page_name)
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows gzip, honouring q-values (q=0 is a refusal)"""
+    wildcard_q = None
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name in ("gzip", "x-gzip"):
+            return q > 0
+        if name == "*":
+            wildcard_q = q
+    return wildcard_q is not None and wildcard_q > 0
+
+
+async def _page_response(request: Request, page_name: str) -> Response:
+    """Return a cached page, gzip-encoded when the client accepts it"""
+    page = _page_cache.get(page_name)
+    if page is None:
+        page = await asyncio.to_thread(_read_html, page_name)
+        _page_cache[page_name] = page
+
+    content, compressed = page
+    if _accepts_gzip(request.headers.get("accept-encoding", "")):
+        return HTMLResponse(
+            content=compressed,
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+        )
+    return HTMLResponse(content=content, headers={"Vary": "Accept-Encoding"})
+
+
 @router.get("/", response_class=HTMLResponse)
-async def get_ui():
+async def get_ui(request: Request):
     """Serve the login page"""
-    html_path = os.path.join('app', 'static', 'login.html')
-    with open(html_path, 'r', encoding='utf-8') as f:
-        return HTMLResponse(content=f.read())
+    return await _page_response(request, 'login.html')
 
 
 @router.post("/auth/login", response_model=Token)
@@ -66,11 +124,9 @@ async def login(login_request: LoginRequest):
 
 
 @router.get("/app", response_class=HTMLResponse)
-async def get_app():
+async def get_app(request: Request):
     """Serve the main application (authentication by frontend)"""
-    html_path = os.path.join('app', 'static', 'view.html')
-    with open(html_path, 'r', encoding='utf-8') as f:
-        return HTMLResponse(content=f.read())
+    return await _page_response(request, 'view.html')
 
 
 @router.get("/status")
@@ -153,11 +209,48 @@ async def get_channels(current_user: str = Depends(get_current_user)):
 
 
 @router.post("/files/list")
-async def list_files(request: DownloadRequest, current_user: str = Depends(get_current_user)):
+async def list_files(request: DownloadRequest, http_request: Request, current_user: str = Depends(get_current_user)):
     """List files from a channel with search and filter options"""
     if not await telegram_service.is_connected():
         raise HTTPException(status_code=400, detail="Not connected. Login first.")
 
+    # Clients that ask for NDJSON get one file per line as soon as it is found,
+    # without buffering the whole listing
+    if "application/x-ndjson" in http_request.headers.get("accept", ""):
+        files = telegram_service.iter_files(
+            request.channel_username,
+            request.limit,
+            request.filter_type,
+            request.search_query,
+            request.min_size,
+            request.max_size,
+            request.date_from,
+            request.date_to,
+            request.file_extension
+        )
+
+        # Pull the first file before committing to a 200 so setup failures (bad channel,
+        # unauthorized session, flood wait) still surface as a 400 like the buffered path
+        try:
+            first_file = await anext(files, None)
+        except Exception as e:
+            logger.error(f"List files error: {str(e)}")
+            raise HTTPException(status_code=400, detail=str(e))
+
+        async def stream_files():
+            if first_file is None:
+                return
+            try:
+                yield orjson.dumps(first_file.model_dump()) + b"\n"
+                async for file_info in files:
+                    yield orjson.dumps(file_info.model_dump()) + b"\n"
+            except Exception as e:
+                # Headers are already sent; end the stream with an explicit error line
+                logger.error(f"List files stream error: {str(e)}")
+                yield orjson.dumps({"error": str(e)}) + b"\n"
+
+        return StreamingResponse(stream_files(), media_type="application/x-ndjson")
+
     try:
         files = await telegram_service.list_files(
             request.channel_username,
@@ -185,11 +278,13 @@ async def download_selected_files(request: DownloadSelectedRequest, background_t
     try:
         session_id = await download_service.download_selected_files(
             request.channel_username,
-            request.message_ids
+            request.message_ids,
+            request.concurrency
         )
+        concurrency = download_service.resolve_concurrency(request.concurrency)
         return {
             "status": "started",
-            "message": f"Downloading {len(request.message_ids)} selected files with {Config.MAX_CONCURRENT_DOWNLOADS} parallel downloads.",
+            "message": f"Downloading {len(request.message_ids)} selected files with {concurrency} parallel downloads.",
             "session_id": session_id
         }
     except Exception as e:
@@ -207,11 +302,13 @@ async def download_all_files(request: DownloadRequest, background_tasks: Backgro
         session_id = await download_service.download_all_files(
             request.channel_username,
             request.limit,
-            request.filter_type
+            request.filter_type,
+            request.concurrency
         )
+        concurrency = download_service.resolve_concurrency(request.concurrency)
         return {
             "status": "started",
-            "message": f"Download started in background with {Config.MAX_CONCURRENT_DOWNLOADS} parallel downloads.",
+            "message": f"Download started in background with {concurrency} parallel downloads.",
             "session_id": session_id
         }
     except Exception as e:
@@ -237,9 +334,8 @@ async def download_file(message_id: int, channel_username: str, background_tasks
             except Exception as e:
                 logger.error(f"Background download error for {file_id}: {str(e)}")
 
-        # Run in background
-        import asyncio
-        asyncio.create_task(download_task())
+        # Run in background, tracked so shutdown can cancel it
+        download_service.track_task(file_id, asyncio.create_task(download_task()))
 
         return {
             "status": "started",
@@ -252,10 +348,24 @@ async def download_file(message_id: int, channel_username: str, background_tasks
         raise HTTPException(status_code=400, detail=error_msg)
 
 
-@router.get("/download-progress")
-async def get_download_progress(current_user: str = Depends(get_current_user)):
+@router.get("/download-progress", response_class=ORJSONResponse)
+async def get_download_progress(request: Request, current_user: str = Depends(get_current_user)):
     """Get the current download progress"""
-    return state_manager.get_status()
+    # Polled at high frequency by the UI; unchanged status costs a bodiless 304
+    etag = state_manager.etag()
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    # Serialize straight through orjson
+    status = state_manager.get_status()
+    return ORJSONResponse({
+        **status,
+        "concurrent_downloads": {
+            file_id: entry.to_dict()
+            for file_id, entry in status.get("concurrent_downloads", {}).items()
+        }
+    }, headers=headers)
 
 
 @router.post("/download/cancel")
@@ -299,7 +409,7 @@ async def get_download_state(current_user: str = Depends(get_current_user)):
         "started_at": status.get("started_at"),
         "progress": status.get("progress", 0),
         "total": status.get("total", 0),
-        "completed_count": len(status.get("completed_downloads", {})),
+        "completed_count": status.get("completed_count", 0),
         "concurrent_count": len(status.get("concurrent_downloads", {}))
     }
 
@@ -308,17 +418,16 @@ async def get_download_state(current_user: str = Depends(get_current_user)):
 async def clear_completed_downloads(current_user: str = Depends(get_current_user)):
     """Clear completed downloads from state"""
     status = state_manager.get_status()
-    status["completed_downloads"] = {}
 
     # Check if there's an active download
     if status.get("active"):
         # Only clear completed downloads, keep the active session
-        status["completed_downloads"] = {}
+        await state_manager.clear_completed()
         status["progress"] = 0  # Reset progress since we're clearing completed
         state_manager.save_state()
     else:
         # No active download, clear everything
-        state_manager.clear_state()
+        await state_manager.clear_state()
     
     return {
         "status": "success",
@@ -328,14 +437,7 @@ async def clear_completed_downloads(current_user: str = Depends(get_current_user
 @router.delete("/download/completed/{file_id}")
 async def clear_individual_download(file_id: str, current_user: str = Depends(get_current_user)):
     """Clear a single completed download from state"""
-    status = state_manager.get_status()
-
-    if file_id in status.get("completed_downloads", {}):
-        del status["completed_downloads"][file_id]
-        # Update progress counter
-        status["progress"] = len(status["completed_downloads"])
-        state_manager.save_state()
-
+    if await state_manager.remove_completed(file_id):
         return {
             "status": "success",
             "message": f"Download {file_id} cleared"
@@ -349,17 +451,7 @@ async def clear_individual_download(file_id: str, current_user: str = Depends(ge
 @router.delete("/download/clear-individual/{file_id}")
 async def clear_individual_download(file_id: str, current_user: str = Depends(get_current_user)):
     """Clear a single completed download from state"""
-    status = state_manager.get_status()
-    completed_downloads = status.get("completed_downloads", {})
-
-    if file_id in completed_downloads:
-        del completed_downloads[file_id]
-        status["completed_downloads"] = completed_downloads
-
-        # Update progress count
-        status["progress"] = len(completed_downloads)
-
-        state_manager.save_state()
+    if await state_manager.remove_completed(file_id):
         return {
             "status": "success",
             "message": f"Download {file_id} cleared"
@@ -371,19 +463,28 @@ async def clear_individual_download(file_id: str, current_user: str = Depends(ge
         }
 
 
+def _scan_downloaded_files(directory: str) -> List[Dict[str, Any]]:
+    """List regular files in a directory using the cached scandir entries"""
+    files = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    files.append({"name": entry.name, "size": entry.stat().st_size, "path": entry.path})
+            except OSError:
+                # Removed between the directory read and the stat
+                continue
+    return files
+
+
 @router.get("/files/downloaded")
 async def list_downloaded_files(current_user: str = Depends(get_current_user)):
     """List all downloaded files"""
     try:
-        files = []
-        for filename in os.listdir(Config.SAVE_PATH):
-            file_path = os.path.join(Config.SAVE_PATH, filename)
-            if os.path.isfile(file_path):
-                files.append({
-                    "name": filename,
-                    "size": os.path.getsize(file_path),
-                    "path": file_path
-                })
+        files = await asyncio.to_thread(_scan_downloaded_files, Config.SAVE_PATH)
+
+        # Pick up files added to the download directory outside of the app
+        state_manager.downloaded_files.update(f["name"] for f in files)
 
         return {"status": "success", "files": files, "count": len(files)}
     except Exception as e:
@@ -391,15 +492,33 @@ async def list_downloaded_files(current_user: str = Depends(get_current_user)):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@router.get("/files/serve/{filename}")
-async def serve_file(filename: str, current_user: str = Depends(get_current_user)):
+class _MediaFileResponse(FileResponse):
+    """FileResponse streaming large media in 1MB reads instead of Starlette's default 64KB"""
+    chunk_size = 1024 * 1024
+
+
+@router.api_route("/files/serve/{filename}", methods=["GET", "HEAD"])
+async def serve_file(filename: str, request: Request, current_user: str = Depends(get_current_user)):
     """Serve a downloaded file"""
+    # O(1) membership check before touching the filesystem
+    if not state_manager.is_downloaded_file(filename):
+        raise HTTPException(status_code=404, detail="File not found")
+
     file_path = os.path.join(Config.SAVE_PATH, filename)
 
-    if not os.path.exists(file_path):
+    # Single stat off the event loop doubles as the existence check; hand it to
+    # FileResponse so Starlette doesn't stat the file again
+    try:
+        file_stat = await asyncio.to_thread(os.stat, file_path)
+    except OSError:
+        state_manager.downloaded_files.discard(filename)
+        raise HTTPException(status_code=404, detail="File not found")
+
+    if not stat.S_ISREG(file_stat.st_mode):
         raise HTTPException(status_code=404, detail="File not found")
 
-    return FileResponse(file_path)
+    # HEAD gets the size and headers without streaming the body
+    return _MediaFileResponse(file_path, stat_result=file_stat, filename=filename, method=request.method)
 
 
 @router.get("/debug/state")
@@ -426,7 +545,7 @@ async def debug_state(current_user: str = Depends(get_current_user)):
             "session_id": status.get("session_id"),
             "channel": status.get("channel"),
             "started_at": status.get("started_at"),
-            "completed_count": len(status.get("completed_downloads", {})),
+            "completed_count": status.get("completed_count", 0),
             "concurrent_count": len(status.get("concurrent_downloads", {})),
             "cancelled": status.get("cancelled")
         },
@@ -462,7 +581,7 @@ async def cleanup_state(current_user: str = Depends(get_current_user)):
             "active": status.get("active"),
             "session_id": status.get("session_id"),
             "channel": status.get("channel"),
-            "completed_count": len(status.get("completed_downloads", {}))
+            "completed_count": status.get("completed_count", 0)
         }
     }
 
@@ -471,7 +590,6 @@ async def cleanup_state(current_user: str = Depends(get_current_user)):
 async def reset_state(current_user: str = Depends(get_current_user)):
     """Completely reset the download state"""
     import shutil
-    from datetime import datetime
 
     # Backup current state first
     if os.path.exists(Config.STATE_FILE):
@@ -482,7 +600,7 @@ async def reset_state(current_user: str = Depends(get_current_user)):
         except Exception as e:
             logger.error(f"Failed to backup state: {e}")
 
-    state_manager.clear_state()
+    await state_manager.clear_state()
 
     return {
         "status": "success",
@@ -510,7 +628,7 @@ async def logout_session(current_user: str = Depends(get_current_user)):
                 logger.info(f"Deleted file: {file_path}")
 
         # Clear download state
-        state_manager.clear_state()
+        await state_manager.clear_state()
 
         await telegram_service.connect()  # Reconnect to allow fresh login next time
 
@@ -1,26 +1,59 @@
 import os
+import logging
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
+
+def _parse_api_id(raw: str) -> int:
+    """Parse API_ID once, falling back to 0 (rejected by Telethon at connect) if it is not a number"""
+    try:
+        return int(raw.strip())
+    except ValueError:
+        logger.error(f"Invalid API_ID {raw!r}: set it to the numeric api_id from my.telegram.org")
+        return 0
+
+
 class Config:
     """Application configuration"""
 
     # Telegram API Configuration
-    API_ID = os.getenv("API_ID")
+    API_ID = _parse_api_id(os.getenv("API_ID", "0"))
     API_HASH = os.getenv("API_HASH")
     PHONE_NUMBER = f'+{os.getenv("PHONE_NUMBER")}'
 
     # Download Configuration
-    MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "3"))
+    MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "8"))
+    # Upper bound for per-request concurrency; each file may also open PARALLEL_DOWNLOAD_PARTS
+    # ranges, so higher values trade memory and flood-wait risk for bandwidth
+    MAX_CONCURRENT_DOWNLOADS_LIMIT = int(os.getenv("MAX_CONCURRENT_DOWNLOADS_LIMIT", "32"))
     SAVE_PATH = os.path.abspath('downloads')
+    # In-progress parallel downloads; kept on the download volume so the final rename stays atomic
+    PARTIAL_PATH = os.path.join(SAVE_PATH, '.partial')
 
     # Telethon Download Configuration
     DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", "524288"))  # 512KB chunks (smaller = more stable)
     DOWNLOAD_REQUEST_DELAY = float(os.getenv("DOWNLOAD_REQUEST_DELAY", "0.1"))  # 100ms delay between chunk requests
+    PARALLEL_DOWNLOAD_PARTS = int(os.getenv("PARALLEL_DOWNLOAD_PARTS", "4"))  # Concurrent byte ranges per large file (1 = off)
+    PARALLEL_DOWNLOAD_MIN_SIZE = int(os.getenv("PARALLEL_DOWNLOAD_MIN_SIZE", str(10 * 1024 * 1024)))  # Only split files >= 10MB
+    DROP_PAGE_CACHE_MIN_SIZE = int(os.getenv("DROP_PAGE_CACHE_MIN_SIZE", str(256 * 1024 * 1024)))  # Evict files >= 256MB from the page cache once written (0 = off)
+
+    # Telegram Client Connection Configuration (one long-lived client is shared by all downloads)
+    TELEGRAM_TIMEOUT = int(os.getenv("TELEGRAM_TIMEOUT", "60"))  # Seconds per request
+    TELEGRAM_REQUEST_RETRIES = int(os.getenv("TELEGRAM_REQUEST_RETRIES", "10"))
+    TELEGRAM_CONNECTION_RETRIES = int(os.getenv("TELEGRAM_CONNECTION_RETRIES", "10"))
+    TELEGRAM_RETRY_DELAY = int(os.getenv("TELEGRAM_RETRY_DELAY", "3"))  # Seconds between retries
+    TELEGRAM_FLOOD_SLEEP_THRESHOLD = int(os.getenv("TELEGRAM_FLOOD_SLEEP_THRESHOLD", "120"))  # Sleep through FLOOD_WAITs up to this many seconds
 
     # Session Configuration
     SESSION_DIR = os.path.abspath('sessions')
     SESSION_FILE = os.path.join(SESSION_DIR, 'telegram_session')
     STATE_FILE = os.path.join(SESSION_DIR, 'download_state.json')
+    COMPLETED_LOG = os.path.join(SESSION_DIR, 'completed_downloads.jsonl')  # Append-only completed file journal
+    STATE_SAVE_INTERVAL = float(os.getenv("STATE_SAVE_INTERVAL", "0.5"))  # Min seconds between progress-driven saves
+
+    # How long /status may reuse the cached authorization check and user info
+    AUTH_STATUS_CACHE_TTL = float(os.getenv("AUTH_STATUS_CACHE_TTL", "5"))
 
     # Server Configuration
     HOST = os.getenv("HOST", "0.0.0.0")
@@ -40,3 +73,4 @@ class Config:
         """Ensure required directories exist"""
         os.makedirs(cls.SESSION_DIR, exist_ok=True)
         os.makedirs(cls.SAVE_PATH, exist_ok=True)
+        os.makedirs(cls.PARTIAL_PATH, exist_ok=True)
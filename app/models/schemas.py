@@ -34,11 +34,13 @@ class DownloadRequest(BaseModel):
     date_from: Optional[str] = None
     date_to: Optional[str] = None
     file_extension: Optional[str] = None
+    concurrency: Optional[int] = None
 
 
 class DownloadSelectedRequest(BaseModel):
     channel_username: str
     message_ids: List[int]
+    concurrency: Optional[int] = None
 
 
 class FileInfo(BaseModel):
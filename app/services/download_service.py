@@ -2,17 +2,27 @@ import os
 import logging
 import asyncio
 from datetime import datetime
-from typing import List, Optional, Dict
-from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Union
 import uuid
 
 from app.config import Config
 from app.services.telegram_service import TelegramService
-from app.utils.state_manager import StateManager
+from app.utils.state_manager import StateManager, DownloadEntry
+from app.utils.media import extract_media_info, extract_file_name
 
 logger = logging.getLogger(__name__)
 
 
+async def _aiter_messages(messages: Union[Iterable, AsyncIterator]) -> AsyncIterator:
+    """Iterate a list or an async iterator of messages uniformly"""
+    if hasattr(messages, "__aiter__"):
+        async for message in messages:
+            yield message
+    else:
+        for message in messages:
+            yield message
+
+
 class DownloadService:
     """Service for managing file downloads"""
 
@@ -20,36 +30,27 @@ class DownloadService:
         self.telegram_service = telegram_service
         self.state_manager = state_manager
         self.active_download_tasks = {}
+        # Set by cancel_download; checked cooperatively from progress callbacks
+        self._cancel_event = asyncio.Event()
 
-    def _get_file_name(self, message) -> str:
-        """Extract file name from message"""
-        if isinstance(message.media, MessageMediaDocument):
-            doc = message.media.document
-            return next((attr.file_name for attr in doc.attributes
-                        if hasattr(attr, 'file_name')), f"document_{message.id}")
-        elif isinstance(message.media, MessageMediaPhoto):
-            return f"photo_{message.id}.jpg"
-        return "unknown"
-
-    async def download_single_file(self, message, target_dir: str, file_id: str, max_retries: int = 3) -> Optional[str]:
+    async def download_single_file(self, message, target_dir: str, file_id: str, max_retries: int = 3,
+                                   file_name: Optional[str] = None) -> Optional[str]:
         """Download a single file with progress tracking and retry logic"""
-        file_name = self._get_file_name(message)
-        logger.info(f"=== DOWNLOAD SINGLE FILE CALLED === file_id={file_id}, file_name={file_name}, target_dir={target_dir}")
+        file_name = file_name or extract_file_name(message)
+        logger.info("=== DOWNLOAD SINGLE FILE CALLED === file_id=%s, file_name=%s, target_dir=%s", file_id, file_name, target_dir)
 
         for attempt in range(max_retries):
             try:
-                logger.info(f"Starting download (attempt {attempt + 1}/{max_retries}): {file_name}")
-                logger.info(f"Message details: id={message.id}, has_media={message.media is not None}")
+                logger.info("Starting download (attempt %s/%s): %s", attempt + 1, max_retries, file_name)
+                logger.info("Message details: id=%s, has_media=%s", message.id, message.media is not None)
 
-                status = self.state_manager.get_status()
-                status["concurrent_downloads"][file_id] = {
-                    "name": file_name,
-                    "progress": 0,
-                    "total": 0,
-                    "percentage": 0,
-                    "retry_attempt": attempt + 1 if attempt > 0 else None
-                }
-                self.state_manager.save_state()
+                # Callbacks and the monitor close over this entry instead of looking it up per tick
+                entry = DownloadEntry(
+                    name=file_name,
+                    retry_attempt=attempt + 1 if attempt > 0 else None
+                )
+                # In-flight entries aren't persisted, so tracking one doesn't need a save
+                self.state_manager.track_download(file_id, entry)
 
                 last_progress_time = datetime.now()
                 last_progress_bytes = 0
@@ -58,39 +59,41 @@ class DownloadService:
                 def progress_callback(current, total):
                     nonlocal last_progress_time, last_progress_bytes
 
-                    if status["cancelled"]:
-                        raise Exception("Download cancelled by user")
+                    if self._cancel_event.is_set():
+                        raise asyncio.CancelledError
 
                     # Check if progress has stalled (no change in 60 seconds)
                     if current == last_progress_bytes:
                         time_since_progress = (datetime.now() - last_progress_time).total_seconds()
                         if time_since_progress > 60:
-                            logger.warning(f"Download stalled at {current}/{total} bytes for {time_since_progress}s")
+                            logger.warning("Download stalled at %d/%d bytes for %ss", current, total, time_since_progress)
                             raise Exception(f"Download stalled - no progress for {time_since_progress}s")
                     else:
                         last_progress_time = datetime.now()
                         last_progress_bytes = current
 
-                    status["concurrent_downloads"][file_id]["progress"] = current
-                    status["concurrent_downloads"][file_id]["total"] = total
-                    status["concurrent_downloads"][file_id]["percentage"] = int((current / total * 100)) if total > 0 else 0
-                    status["concurrent_downloads"][file_id]["last_update"] = datetime.now().isoformat()
-                    self.state_manager.save_state()
+                    entry.progress = current
+                    entry.total = total
+                    entry.last_update = datetime.now().isoformat()
+                    self.state_manager.maybe_save_state(force=current == total)
 
                 # Create a task to monitor overall progress even when callback isn't called
                 async def download_with_monitoring():
-                    logger.info(f"")
-                    logger.info(f"{'='*80}")
-                    logger.info(f"=== DOWNLOAD_WITH_MONITORING FUNCTION STARTED ===")
-                    logger.info(f"=== file_name={file_name}, file_id={file_id}")
-                    logger.info(f"{'='*80}")
+                    logger.info("")
+                    logger.info("%s", "=" * 80)
+                    logger.info("=== DOWNLOAD_WITH_MONITORING FUNCTION STARTED ===")
+                    logger.info("=== file_name=%s, file_id=%s", file_name, file_id)
+                    logger.info("%s", "=" * 80)
 
                     # Determine the expected file path
                     expected_file_path = os.path.join(target_dir, file_name)
-                    logger.info(f"Expected file path: {expected_file_path}")
-                    logger.info(f"Target directory exists: {os.path.exists(target_dir)}")
+                    # Large documents are assembled in a preallocated part file whose size
+                    # says nothing about progress; those report through progress_callback only
+                    partial_path = self.telegram_service.partial_path(message)
+                    logger.info("Expected file path: %s", expected_file_path)
+                    logger.info("Target directory exists: %s", os.path.exists(target_dir))
 
-                    logger.info(f"Creating download task via telegram_service.download_media...")
+                    logger.info("Creating download task via telegram_service.download_media...")
                     try:
                         download_task = asyncio.create_task(
                             self.telegram_service.download_media(
@@ -99,9 +102,9 @@ class DownloadService:
                                 progress_callback
                             )
                         )
-                        logger.info(f"✓ Download task created successfully: {download_task}")
+                        logger.info("✓ Download task created successfully: %s", download_task)
                     except Exception as e:
-                        logger.error(f"✗ Failed to create download task: {e}")
+                        logger.error("✗ Failed to create download task: %s", e)
                         raise
 
                     last_check_file_size = -1  # Use -1 to indicate initial state
@@ -112,17 +115,17 @@ class DownloadService:
                         try:
                             await asyncio.sleep(5)  # Check every 5 seconds
                         except asyncio.CancelledError:
-                            logger.warning(f"Monitor sleep cancelled for {file_name}")
+                            logger.warning("Monitor sleep cancelled for %s", file_name)
                             download_task.cancel()
                             raise
 
                         check_count += 1
 
                         if download_task.done():
-                            logger.info(f"Download task completed for {file_name}")
+                            logger.info("Download task completed for %s", file_name)
                             break
 
-                        logger.debug(f"Monitor loop iteration {check_count} for {file_name}")
+                        logger.debug("Monitor loop iteration %d for %s", check_count, file_name)
 
                         # Check actual file size on disk
                         actual_file_size = 0
@@ -130,101 +133,108 @@ class DownloadService:
                             actual_file_size = os.path.getsize(expected_file_path)
 
                         # Also check state for reported progress
-                        status = self.state_manager.get_status()
-                        current_status = status.get("concurrent_downloads", {}).get(file_id, {})
-                        state_bytes = current_status.get("progress", 0)
-                        total_bytes = current_status.get("total", 0)
-                        percentage = current_status.get("percentage", 0)
+                        state_bytes = entry.progress
+                        total_bytes = entry.total
+                        percentage = entry.percentage
 
-                        logger.info(f"Monitor check #{check_count} for {file_name}: state={state_bytes}/{total_bytes} ({percentage}%), disk={actual_file_size}")
+                        if not actual_file_size and partial_path and os.path.exists(partial_path):
+                            logger.debug("Monitor check #%d for %s: state=%d/%d (%d%%), assembling in %s",
+                                         check_count, file_name, state_bytes, total_bytes, percentage, partial_path)
+                            continue
+
+                        logger.debug("Monitor check #%d for %s: state=%d/%d (%d%%), disk=%d",
+                                     check_count, file_name, state_bytes, total_bytes, percentage, actual_file_size)
 
                         # Just log the progress, stall detection is handled by progress_callback
                         # File monitor stall detection removed to avoid false positives from buffering
                         if actual_file_size != last_check_file_size:
                             if last_check_file_size >= 0:
-                                logger.info(f"File growing: {last_check_file_size} -> {actual_file_size} bytes (+{actual_file_size - last_check_file_size})")
+                                logger.debug("File growing: %d -> %d bytes (+%d)", last_check_file_size,
+                                             actual_file_size, actual_file_size - last_check_file_size)
                             else:
-                                logger.info(f"First check: file size = {actual_file_size} bytes")
+                                logger.debug("First check: file size = %d bytes", actual_file_size)
                             last_check_file_size = actual_file_size
                         else:
-                            logger.debug(f"File size unchanged: {actual_file_size} bytes (this is normal during buffering)")
+                            logger.debug("File size unchanged: %d bytes (this is normal during buffering)", actual_file_size)
 
                             # Update state with actual file size if callback hasn't been called
                             if state_bytes == 0 and actual_file_size > 0:
-                                logger.info(f"Updating state with actual file size: {actual_file_size}")
-                                status["concurrent_downloads"][file_id]["progress"] = actual_file_size
-                                if total_bytes > 0:
-                                    status["concurrent_downloads"][file_id]["percentage"] = int((actual_file_size / total_bytes * 100))
-                                status["concurrent_downloads"][file_id]["last_update"] = datetime.now().isoformat()
-                                self.state_manager.save_state()
+                                logger.info("Updating state with actual file size: %s", actual_file_size)
+                                entry.progress = actual_file_size
+                                entry.last_update = datetime.now().isoformat()
+                                self.state_manager.maybe_save_state()
 
                     result = await download_task
-                    logger.info(f"Download task finished for {file_name}")
+                    logger.info("Download task finished for %s", file_name)
 
                     # Verify the file was actually downloaded
                     if result and os.path.exists(result):
                         final_size = os.path.getsize(result)
-                        logger.info(f"Download completed successfully: {file_name}, size: {final_size} bytes")
+                        logger.info("Download completed successfully: %s, size: %s bytes", file_name, final_size)
                     else:
-                        logger.warning(f"Download task returned but file not found: {result}")
+                        logger.warning("Download task returned but file not found: %s", result)
 
                     return result
 
                 # Add timeout wrapper for the download (20 minutes per file)
-                logger.info(f"About to call download_with_monitoring() with 1200s timeout")
+                logger.info("About to call download_with_monitoring() with 1200s timeout")
                 try:
                     file_path = await asyncio.wait_for(
                         download_with_monitoring(),
                         timeout=1200  # 20 minutes timeout for entire download
                     )
-                    logger.info(f"download_with_monitoring() completed, file_path={file_path}")
+                    logger.info("download_with_monitoring() completed, file_path=%s", file_path)
                 except asyncio.TimeoutError:
-                    logger.error(f"Download timeout after 20 minutes for {file_name}")
+                    logger.error("Download timeout after 20 minutes for %s", file_name)
                     raise Exception("Download timeout - exceeded 20 minutes")
                 except asyncio.CancelledError:
-                    logger.warning(f"Download cancelled (likely due to stall) for {file_name}")
+                    # User cancellation or this task being cancelled propagates as-is
+                    if self._cancel_event.is_set() or asyncio.current_task().cancelling():
+                        raise
+                    logger.warning("Download cancelled (likely due to stall) for %s", file_name)
                     raise Exception("Download stalled and was cancelled")
                 except Exception as e:
-                    logger.error(f"Exception in download_with_monitoring: {type(e).__name__}: {str(e)}")
+                    logger.error("Exception in download_with_monitoring: %s: %s", type(e).__name__, e)
                     raise
 
                 if file_path:
                     # Get the final file size from disk
                     final_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
 
-                    # If we don't have the size from disk, try to get from concurrent state
-                    status = self.state_manager.get_status()
-                    if final_size == 0 and file_id in status.get("concurrent_downloads", {}):
-                        final_size = status["concurrent_downloads"][file_id].get("total", 0)
+                    # If we don't have the size from disk, fall back to the reported total
+                    if final_size == 0:
+                        final_size = entry.total
 
                     # Use thread-safe method to mark file as completed
                     file_data = {
                         "name": file_name,
+                        "message_id": message.id,
                         "path": file_path,
                         "size": final_size,
                         "percentage": 100,
+                        # Formatted once here so status polls serialize the stored string as is
                         "completed_at": datetime.now().isoformat()
                     }
                     await self.state_manager.mark_file_completed(file_id, file_data)
 
-                    logger.info(f"Completed download: {file_name}, size: {final_size} bytes, marked as 100%")
+                    logger.info("Completed download: %s, size: %s bytes, marked as 100%%", file_name, final_size)
                     return file_path
                 else:
-                    logger.warning(f"Download completed but no file path returned for {file_name}")
+                    logger.warning("Download completed but no file path returned for %s", file_name)
                     return None
 
+            except asyncio.CancelledError:
+                logger.info("Download cancelled: %s", file_name)
+                self.state_manager.untrack_download(file_id)
+
+                # Keep structured cancellation intact when the task itself is being cancelled
+                if asyncio.current_task().cancelling():
+                    raise
+                return None
+
             except Exception as e:
                 error_msg = str(e)
 
-                # Check if user cancelled
-                if "cancelled" in error_msg.lower():
-                    logger.info(f"Download cancelled by user: {file_name}")
-                    status = self.state_manager.get_status()
-                    if file_id in status["concurrent_downloads"]:
-                        del status["concurrent_downloads"][file_id]
-                    self.state_manager.save_state()
-                    return None
-
                 # Check if it's a timeout/stall error from Telegram
                 is_timeout = (
                     "timeout" in error_msg.lower() or
@@ -236,57 +246,170 @@ class DownloadService:
                 if is_timeout and attempt < max_retries - 1:
                     # Calculate exponential backoff: 2^attempt seconds (2s, 4s, 8s)
                     wait_time = 2 ** attempt
-                    logger.warning(f"Telegram timeout for {file_name}. Retrying in {wait_time}s... (attempt {attempt + 1}/{max_retries})")
+                    logger.warning("Telegram timeout for %s. Retrying in %ss... (attempt %s/%s)", file_name, wait_time, attempt + 1, max_retries)
                     await asyncio.sleep(wait_time)
                     continue
                 else:
                     # Final attempt failed or non-timeout error
-                    logger.error(f"Error downloading {file_name} after {attempt + 1} attempts: {error_msg}")
-                    status = self.state_manager.get_status()
-                    if file_id in status["concurrent_downloads"]:
-                        del status["concurrent_downloads"][file_id]
-                    self.state_manager.save_state()
+                    logger.error("Error downloading %s after %s attempts: %s", file_name, attempt + 1, error_msg)
+                    self.state_manager.untrack_download(file_id)
                     return None
 
         # Should not reach here, but just in case
         return None
 
-    async def download_selected_files(self, channel_username: str, message_ids: List[int]) -> str:
+    @staticmethod
+    def _completed_message_id(file_id: str, file_data: Dict) -> Optional[int]:
+        """Message id of a completed record, parsed from the file id for records written before message_id was stored"""
+        message_id = file_data.get("message_id")
+        if message_id is not None:
+            return message_id
+        try:
+            return int(file_id.rsplit("_", 1)[-1])
+        except ValueError:
+            return None
+
+    def _find_completed_on_disk(self, completed_items: List[tuple], message_ids: List[int]) -> Dict[int, tuple]:
+        """Map message id -> (file_id, file_data) for completed downloads still on disk at their recorded size"""
+        wanted = set(message_ids)
+        found = {}
+        for file_id, file_data in completed_items:
+            message_id = self._completed_message_id(file_id, file_data)
+            if message_id not in wanted:
+                continue
+
+            path = file_data.get("path")
+            try:
+                if path and os.path.getsize(path) == file_data.get("size"):
+                    found[message_id] = (file_id, file_data)
+            except OSError:
+                continue
+        return found
+
+    @staticmethod
+    def resolve_concurrency(requested: Optional[int] = None) -> int:
+        """Clamp a requested concurrency to 1..MAX_CONCURRENT_DOWNLOADS_LIMIT"""
+        concurrency = requested or Config.MAX_CONCURRENT_DOWNLOADS
+        return max(1, min(concurrency, Config.MAX_CONCURRENT_DOWNLOADS_LIMIT))
+
+    async def _download_messages(self, messages: Union[List, AsyncIterator], target_dir: str, index_offset: int = 0,
+                                 concurrency: Optional[int] = None, track_frontier: bool = False) -> List[str]:
+        """Download messages with a bounded queue feeding `concurrency` workers
+
+        `messages` may be a list or an async iterator; with an iterator the first
+        downloads start while the channel is still being scanned. A worker picks up
+        the next file as soon as it is free, so one slow file never holds back others.
+
+        With track_frontier, messages must arrive newest first; resume_offset_id is
+        kept at the oldest message id below which nothing has completed out of order.
+        """
+        worker_count = self.resolve_concurrency(concurrency)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=worker_count * 4)
+        status = self.state_manager.get_status()
+        produced_ids = []
+        finished_ids = set()
+        frontier_index = 0
+        downloaded = []
+        scan_error: Optional[Exception] = None
+
+        def advance_frontier(message_id: int):
+            nonlocal frontier_index
+            finished_ids.add(message_id)
+            while frontier_index < len(produced_ids) and produced_ids[frontier_index] in finished_ids:
+                frontier_index += 1
+            if frontier_index:
+                status["resume_offset_id"] = produced_ids[frontier_index - 1]
+                self.state_manager.maybe_save_state()
+
+        async def produce():
+            nonlocal scan_error
+            index = index_offset
+            try:
+                async for message in _aiter_messages(messages):
+                    if self._cancel_event.is_set():
+                        break
+                    produced_ids.append(message.id)
+                    await queue.put((message, f"file_{index}_{message.id}"))
+                    index += 1
+            except Exception as e:
+                # Let the workers finish what was already queued, then surface the error
+                logger.error("Message scan failed: %s", e)
+                scan_error = e
+            for _ in range(worker_count):
+                await queue.put(None)
+
+        async def work():
+            while True:
+                item = await queue.get()
+                if item is None or self._cancel_event.is_set():
+                    return
+                message, file_id = item
+                try:
+                    result = await self.download_single_file(message, target_dir, file_id)
+                except Exception as e:
+                    logger.error("Download task failed: %s", e)
+                    continue
+
+                if result:
+                    downloaded.append(result)
+                    if track_frontier:
+                        advance_frontier(message.id)
+                    # Progress counter is updated in download_single_file
+                    logger.info("Downloaded (%s/%s): %s", len(downloaded), status.get('total', 0), result)
+
+        producer = asyncio.create_task(produce())
+        workers = [asyncio.create_task(work()) for _ in range(worker_count)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # Stops a producer blocked on a full queue after a cancel, or everything when we are cancelled
+            producer.cancel()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(producer, *workers, return_exceptions=True)
+
+        if self._cancel_event.is_set():
+            logger.info("Download cancelled by user")
+        elif scan_error is not None:
+            raise scan_error
+
+        return downloaded
+
+    async def download_selected_files(self, channel_username: str, message_ids: List[int],
+                                      concurrency: Optional[int] = None) -> str:
         """Download selected files with parallel processing"""
-        logger.info(f"Starting download of {len(message_ids)} selected files")
+        logger.info("Starting download of %s selected files", len(message_ids))
+
+        # Files completed by a previous session for this channel that are still on disk are skipped
+        status = self.state_manager.get_status()
+        previous_completed = (
+            list(status.get("completed_downloads", {}).items())
+            if status.get("channel") == channel_username else []
+        )
+        already_completed = await asyncio.to_thread(self._find_completed_on_disk, previous_completed, message_ids)
+        if already_completed:
+            logger.info("Skipping %s files already downloaded", len(already_completed))
+        remaining_ids = [message_id for message_id in message_ids if message_id not in already_completed]
 
         # Initialize new session
-        session_id = str(uuid.uuid4())
-        self.state_manager.update_status({
-            "active": True,
-            "progress": 0,
-            "total": len(message_ids),
-            "current_file": "",
-            "current_file_progress": 0,
-            "current_file_size": 0,
-            "downloaded_bytes": 0,
-            "concurrent_downloads": {},
-            "completed_downloads": {},
-            "cancelled": False,
-            "session_id": session_id,
-            "started_at": datetime.now().isoformat(),
-            "channel": channel_username
-        })
+        self._cancel_event.clear()
+        session_id = await self.state_manager.start_session(channel_username, total=len(message_ids))
+        await self.state_manager.mark_files_completed(dict(already_completed.values()))
 
         async def download_task():
             try:
                 target_dir = Config.SAVE_PATH
-                os.makedirs(target_dir, exist_ok=True)
+                await asyncio.to_thread(os.makedirs, target_dir, exist_ok=True)
 
-                logger.info(f"Fetching {len(message_ids)} messages from {channel_username}")
-                messages_to_download = await self.telegram_service.get_messages(channel_username, message_ids)
+                logger.info("Fetching %s messages from %s", len(remaining_ids), channel_username)
+                messages_to_download = await self.telegram_service.get_messages(channel_username, remaining_ids)
 
                 total_files = len(messages_to_download)
                 status = self.state_manager.get_status()
-                status["total"] = total_files
+                status["total"] = total_files + len(already_completed)
                 self.state_manager.save_state()
 
-                logger.info(f"Found {total_files} files to download. MAX_CONCURRENT_DOWNLOADS={Config.MAX_CONCURRENT_DOWNLOADS}")
+                logger.info("Found %s files to download. concurrency=%s", total_files, self.resolve_concurrency(concurrency))
 
                 if total_files == 0:
                     logger.warning("No files to download!")
@@ -294,157 +417,102 @@ class DownloadService:
                     self.state_manager.save_state()
                     return
 
-                downloaded = []
-
-                for i in range(0, len(messages_to_download), Config.MAX_CONCURRENT_DOWNLOADS):
-                    if status["cancelled"]:
-                        logger.info("Download cancelled by user")
-                        break
-
-                    batch = messages_to_download[i:i + Config.MAX_CONCURRENT_DOWNLOADS]
-                    logger.info(f"Processing batch {i // Config.MAX_CONCURRENT_DOWNLOADS + 1}, {len(batch)} files")
-
-                    tasks = []
-                    for idx, message in enumerate(batch):
-                        file_id = f"file_{i + idx}_{message.id}"
-                        tasks.append(self.download_single_file(message, target_dir, file_id))
-
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                    for result in results:
-                        if result and not isinstance(result, Exception):
-                            downloaded.append(result)
-                            # Progress counter is now updated in download_single_file
-                            logger.info(f"Downloaded ({len(downloaded)}/{total_files}): {result}")
+                downloaded = await self._download_messages(
+                    messages_to_download, target_dir, index_offset=len(already_completed),
+                    concurrency=concurrency
+                )
 
                 status["active"] = False
-                status["concurrent_downloads"] = {}
+                self.state_manager.clear_concurrent()
                 self.state_manager.save_state()
-                logger.info(f"Download completed. Total files: {len(downloaded)}")
+                logger.info("Download completed. Total files: %s", len(downloaded))
 
             except Exception as e:
                 status = self.state_manager.get_status()
                 status["active"] = False
-                status["concurrent_downloads"] = {}
+                self.state_manager.clear_concurrent()
                 self.state_manager.save_state()
-                logger.error(f"Background download error: {str(e)}", exc_info=True)
+                logger.error("Background download error: %s", e, exc_info=True)
 
         # Create task and track it
         task = asyncio.create_task(download_task())
-        self.active_download_tasks[session_id] = task
+        self.track_task(session_id, task)
 
         return session_id
 
-    async def download_all_files(self, channel_username: str, limit: int, filter_type: Optional[str] = None) -> str:
+    async def download_all_files(self, channel_username: str, limit: int, filter_type: Optional[str] = None,
+                                 concurrency: Optional[int] = None) -> str:
         """Download all files from channel"""
-        logger.info(f"Starting download-all from {channel_username}, limit={limit}")
+        logger.info("Starting download-all from %s, limit=%s", channel_username, limit)
 
         # Initialize new session
-        session_id = str(uuid.uuid4())
-        self.state_manager.update_status({
-            "active": True,
-            "progress": 0,
-            "total": 0,
-            "current_file": "",
-            "current_file_progress": 0,
-            "current_file_size": 0,
-            "downloaded_bytes": 0,
-            "concurrent_downloads": {},
-            "completed_downloads": {},
-            "cancelled": False,
-            "session_id": session_id,
-            "started_at": datetime.now().isoformat(),
-            "channel": channel_username
-        })
+        self._cancel_event.clear()
+        session_id = await self.state_manager.start_session(channel_username)
 
         async def download_task():
             try:
                 target_dir = Config.SAVE_PATH
-                os.makedirs(target_dir, exist_ok=True)
-
-                logger.info("Fetching messages from channel...")
-                messages_to_download = []
-
-                async for message in await self.telegram_service.iter_messages(channel_username, limit):
-                    if message.media:
-                        should_download = False
+                await asyncio.to_thread(os.makedirs, target_dir, exist_ok=True)
 
-                        if isinstance(message.media, MessageMediaDocument):
-                            if not filter_type or filter_type == 'document':
-                                should_download = True
-                        elif isinstance(message.media, MessageMediaPhoto):
-                            if not filter_type or filter_type == 'photo':
-                                should_download = True
-
-                        if should_download:
-                            messages_to_download.append(message)
-
-                total_files = len(messages_to_download)
+                logger.info("Scanning %s, concurrency=%s", channel_username, self.resolve_concurrency(concurrency))
                 status = self.state_manager.get_status()
-                status["total"] = total_files
-                self.state_manager.save_state()
 
-                logger.info(f"Found {total_files} files to download. MAX_CONCURRENT_DOWNLOADS={Config.MAX_CONCURRENT_DOWNLOADS}")
+                async def scan_channel():
+                    """Yield matching media messages while growing the session total and id window"""
+                    async for message in await self.telegram_service.iter_messages(channel_username, limit):
+                        # One type dispatch per message; the result is memoized for download_single_file
+                        media_info = extract_media_info(message)
+                        if media_info is None:
+                            continue
+                        if filter_type and filter_type != media_info[1]:
+                            continue
+
+                        # Messages arrive newest first; resume pages only through this id window
+                        if status["total"] == 0:
+                            status["resume_offset_id"] = message.id + 1
+                        status["window_min_id"] = message.id
+                        status["total"] += 1
+                        self.state_manager.maybe_save_state()
+                        yield message
+
+                downloaded = await self._download_messages(
+                    scan_channel(), target_dir, concurrency=concurrency, track_frontier=True
+                )
 
-                if total_files == 0:
+                if status["total"] == 0:
                     logger.warning("No files to download!")
-                    status["active"] = False
-                    self.state_manager.save_state()
-                    return
-
-                downloaded = []
-
-                for i in range(0, len(messages_to_download), Config.MAX_CONCURRENT_DOWNLOADS):
-                    if status["cancelled"]:
-                        logger.info("Download cancelled by user")
-                        break
-
-                    batch = messages_to_download[i:i + Config.MAX_CONCURRENT_DOWNLOADS]
-                    logger.info(f"Processing batch {i // Config.MAX_CONCURRENT_DOWNLOADS + 1}, {len(batch)} files")
-
-                    tasks = []
-                    for idx, message in enumerate(batch):
-                        file_id = f"file_{i + idx}_{message.id}"
-                        tasks.append(self.download_single_file(message, target_dir, file_id))
-
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                    for result in results:
-                        if result and not isinstance(result, Exception):
-                            downloaded.append(result)
-                            # Progress counter is now updated in download_single_file
-                            logger.info(f"Downloaded ({len(downloaded)}/{total_files}): {result}")
 
                 status["active"] = False
-                status["concurrent_downloads"] = {}
+                self.state_manager.clear_concurrent()
                 self.state_manager.save_state()
-                logger.info(f"Download completed. Total files: {len(downloaded)}")
+                logger.info("Download completed. Total files: %s", len(downloaded))
 
             except Exception as e:
                 status = self.state_manager.get_status()
                 status["active"] = False
-                status["concurrent_downloads"] = {}
+                self.state_manager.clear_concurrent()
                 self.state_manager.save_state()
-                logger.error(f"Background download error: {str(e)}", exc_info=True)
+                logger.error("Background download error: %s", e, exc_info=True)
 
         # Create task and track it
         task = asyncio.create_task(download_task())
-        self.active_download_tasks[session_id] = task
+        self.track_task(session_id, task)
 
         return session_id
 
     async def download_single(self, channel_username: str, message_id: int) -> Dict:
         """Download a single file with retry mechanism"""
         target_dir = Config.SAVE_PATH
-        os.makedirs(target_dir, exist_ok=True)
+        await asyncio.to_thread(os.makedirs, target_dir, exist_ok=True)
 
         message = await self.telegram_service.get_message(channel_username, message_id)
         if not message or not message.media:
             raise ValueError("File not found")
 
-        file_name = self._get_file_name(message)
+        file_name = extract_file_name(message)
         file_id = f"single_{message_id}"
 
+        self._cancel_event.clear()
         status = self.state_manager.get_status()
         status.update({
             "active": True,
@@ -454,7 +522,7 @@ class DownloadService:
             "downloaded_bytes": 0,
             "cancelled": False,
             "channel": channel_username,
-            "session_id": status.get("session_id") or str(uuid.uuid4()),
+            "session_id": status.get("session_id") or uuid.uuid4().hex,
             "started_at": status.get("started_at") or datetime.now().isoformat(),
             "progress": 0,
             "total": 1
@@ -463,9 +531,9 @@ class DownloadService:
 
         # Use the robust download_single_file method which has retry and stall detection
         try:
-            file_path = await self.download_single_file(message, target_dir, file_id)
+            file_path = await self.download_single_file(message, target_dir, file_id, file_name=file_name)
         except Exception as e:
-            logger.error(f"Failed to download single file: {e}")
+            logger.error("Failed to download single file: %s", e)
             file_path = None
 
         status = self.state_manager.get_status()
@@ -489,6 +557,7 @@ class DownloadService:
 
         if status["active"] or status["current_file_progress"] > 0:
             status["cancelled"] = True
+            self._cancel_event.set()
             self.state_manager.save_state()
 
             # Cancel active tasks
@@ -501,14 +570,14 @@ class DownloadService:
 
             status.update({
                 "active": False,
-                "progress": len(status.get("completed_downloads", {})),
+                "progress": status.get("completed_count", 0),
                 "current_file": "",
                 "current_file_progress": 0,
                 "current_file_size": 0,
                 "downloaded_bytes": 0,
-                "concurrent_downloads": {},
                 "cancelled": True
             })
+            self.state_manager.clear_concurrent()
             self.state_manager.save_state()
 
             logger.info("Download cancellation requested")
@@ -540,40 +609,49 @@ class DownloadService:
 
         channel = status.get("channel")
         total = status.get("total", 0)
+        window_min_id = status.get("window_min_id")
+        resume_offset_id = status.get("resume_offset_id")
 
-        # Get completed file IDs to skip them
-        completed_ids = set()
-        for file_id, data in status.get("completed_downloads", {}).items():
-            if "_" in file_id:
-                parts = file_id.split("_")
-                if len(parts) >= 3:
-                    try:
-                        completed_ids.add(int(parts[-1]))
-                    except:
-                        pass
+        # Get completed message IDs to skip them
+        completed_ids = {
+            self._completed_message_id(file_id, file_data)
+            for file_id, file_data in status.get("completed_downloads", {}).items()
+        }
+        completed_ids.discard(None)
 
-        logger.info(f"Resuming download session {status.get('session_id')}")
-        logger.info(f"Channel: {channel}, Total: {total}, Completed: {len(completed_ids)}")
+        logger.info("Resuming download session %s", status.get('session_id'))
+        logger.info("Channel: %s, Total: %s, Completed: %s", channel, total, len(completed_ids))
 
         status["active"] = True
         status["cancelled"] = False
+        self._cancel_event.clear()
         self.state_manager.save_state()
 
         async def resume_task():
             try:
                 target_dir = Config.SAVE_PATH
-                os.makedirs(target_dir, exist_ok=True)
+                await asyncio.to_thread(os.makedirs, target_dir, exist_ok=True)
+
+                logger.info("Fetching messages from %s to resume download...", channel)
 
-                logger.info(f"Fetching messages from {channel} to resume download...")
+                if window_min_id:
+                    # Only page through the part of the original window that is not known complete
+                    messages = await self.telegram_service.iter_messages(
+                        channel, None,
+                        offset_id=resume_offset_id or 0,
+                        min_id=window_min_id - 1
+                    )
+                else:
+                    messages = await self.telegram_service.iter_messages(channel, total)
 
-                # Fetch all messages again and filter out completed ones
+                # completed_ids still filters files that finished out of order
                 messages_to_download = []
-                async for message in await self.telegram_service.iter_messages(channel, total):
-                    if message.media and message.id not in completed_ids:
+                async for message in messages:
+                    if message.id not in completed_ids and extract_media_info(message) is not None:
                         messages_to_download.append(message)
 
                 remaining_files = len(messages_to_download)
-                logger.info(f"Found {remaining_files} remaining files to download out of {total} total")
+                logger.info("Found %s remaining files to download out of %s total", remaining_files, total)
 
                 if remaining_files == 0:
                     logger.info("All files already downloaded!")
@@ -583,49 +661,31 @@ class DownloadService:
                     self.state_manager.save_state()
                     return
 
-                downloaded = []
-
-                # Process remaining files in batches
-                for i in range(0, len(messages_to_download), Config.MAX_CONCURRENT_DOWNLOADS):
-                    status = self.state_manager.get_status()
-                    if status["cancelled"]:
-                        logger.info("Download cancelled by user")
-                        break
-
-                    batch = messages_to_download[i:i + Config.MAX_CONCURRENT_DOWNLOADS]
-                    logger.info(f"Processing batch {i // Config.MAX_CONCURRENT_DOWNLOADS + 1}, {len(batch)} files")
-
-                    tasks = []
-                    for idx, message in enumerate(batch):
-                        file_id = f"file_{len(completed_ids) + i + idx}_{message.id}"
-                        tasks.append(self.download_single_file(message, target_dir, file_id))
-
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                    for result in results:
-                        if result and not isinstance(result, Exception):
-                            downloaded.append(result)
-                            logger.info(f"Downloaded ({len(completed_ids) + len(downloaded)}/{total}): {result}")
+                downloaded = await self._download_messages(
+                    messages_to_download, target_dir, index_offset=len(completed_ids),
+                    track_frontier=bool(window_min_id)
+                )
+                logger.info("Resumed %s files (%s/%s)", len(downloaded), len(completed_ids) + len(downloaded), total)
 
                 status = self.state_manager.get_status()
                 status["active"] = False
-                status["concurrent_downloads"] = {}
-                status["progress"] = len(status.get("completed_downloads", {}))
+                self.state_manager.clear_concurrent()
+                status["progress"] = status.get("completed_count", 0)
                 self.state_manager.save_state()
-                logger.info(f"Resume completed. Total files now: {status['progress']}/{total}")
+                logger.info("Resume completed. Total files now: %s/%s", status['progress'], total)
 
             except Exception as e:
                 status = self.state_manager.get_status()
                 status["active"] = False
-                status["concurrent_downloads"] = {}
+                self.state_manager.clear_concurrent()
                 self.state_manager.save_state()
-                logger.error(f"Resume download error: {str(e)}", exc_info=True)
+                logger.error("Resume download error: %s", e, exc_info=True)
 
         # Create task and track it
-        task_id = status.get("session_id") or str(uuid.uuid4())
+        task_id = status.get("session_id") or uuid.uuid4().hex
         status["session_id"] = task_id
         task = asyncio.create_task(resume_task())
-        self.active_download_tasks[task_id] = task
+        self.track_task(task_id, task)
 
         return {
             "status": "resumed",
@@ -636,9 +696,24 @@ class DownloadService:
             "total": total
         }
 
-    def cleanup_tasks(self):
-        """Cleanup active download tasks"""
-        for task_id, task in list(self.active_download_tasks.items()):
+    def track_task(self, task_id: str, task: asyncio.Task):
+        """Track a background download task until it finishes"""
+        self.active_download_tasks[task_id] = task
+        task.add_done_callback(lambda done_task, tid=task_id: self._forget_task(tid, done_task))
+
+    def _forget_task(self, task_id: str, task: asyncio.Task):
+        """Drop a finished task, unless the id has since been reused by a newer task"""
+        if self.active_download_tasks.get(task_id) is task:
+            del self.active_download_tasks[task_id]
+
+    async def cleanup_tasks(self):
+        """Cancel active download tasks and wait for them to finish unwinding"""
+        tasks = list(self.active_download_tasks.items())
+        for task_id, task in tasks:
             if not task.done():
                 task.cancel()
-                logger.info(f"Cancelled task {task_id} during cleanup")
+                logger.info("Cancelled task %s during cleanup", task_id)
+
+        # Let cancellation handlers run before the final state save
+        await asyncio.gather(*(task for _, task in tasks), return_exceptions=True)
+        self.active_download_tasks.clear()
@@ -1,12 +1,16 @@
+import os
+import time
+import asyncio
 import logging
-from typing import Optional, List
+from typing import Optional, List, Dict, Any, AsyncIterator, Tuple
 from datetime import datetime
-from telethon import TelegramClient
-from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto, Channel, User
+from telethon import TelegramClient, utils
+from telethon.tl.types import Channel, User
 from telethon.network import ConnectionTcpMTProxyRandomizedIntermediate
 
 from app.config import Config
 from app.models.schemas import FileInfo
+from app.utils.media import extract_media_info
 
 logger = logging.getLogger(__name__)
 
@@ -16,23 +20,55 @@ class TelegramService:
 
     def __init__(self):
         self.client: Optional[TelegramClient] = None
+        self._entity_cache: Dict[str, Any] = {}
+        # (monotonic timestamp, value) pairs reused by /status for AUTH_STATUS_CACHE_TTL
+        self._authorized_cache: Optional[Tuple[float, bool]] = None
+        self._me_cache: Optional[Tuple[float, Any]] = None
+        # Serializes client creation so concurrent callers never open two connections
+        self._client_lock = asyncio.Lock()
+
+    def _invalidate_auth_cache(self):
+        """Forget cached authorization state (after login, logout or reconnect)"""
+        self._authorized_cache = None
+        self._me_cache = None
+
+    def _create_client(self) -> TelegramClient:
+        """Build the Telegram client with optimized settings"""
+        return TelegramClient(
+            Config.SESSION_FILE,
+            Config.API_ID,
+            Config.API_HASH,
+            # Optimizations for better reliability
+            timeout=Config.TELEGRAM_TIMEOUT,
+            request_retries=Config.TELEGRAM_REQUEST_RETRIES,
+            connection_retries=Config.TELEGRAM_CONNECTION_RETRIES,
+            retry_delay=Config.TELEGRAM_RETRY_DELAY,
+            # Wait out short flood waits in-client instead of failing the file and re-handshaking on retry
+            flood_sleep_threshold=Config.TELEGRAM_FLOOD_SLEEP_THRESHOLD,
+            auto_reconnect=True,  # Auto-reconnect on disconnect
+            sequential_updates=True  # Process updates sequentially
+        )
+
+    async def _ensure_client(self) -> TelegramClient:
+        """Return a connected client, creating it at most once under the lock"""
+        async with self._client_lock:
+            if self.client is None:
+                self._invalidate_auth_cache()
+                self.client = self._create_client()
+            if not self.client.is_connected():
+                await self.client.connect()
+            return self.client
 
     async def connect(self):
         """Connect to Telegram with optimized settings"""
         try:
-            self.client = TelegramClient(
-                Config.SESSION_FILE,
-                Config.API_ID,
-                Config.API_HASH,
-                # Optimizations for better reliability
-                timeout=60,  # Increased timeout for requests (was 30s)
-                request_retries=10,  # More retries for failed requests (was 5)
-                connection_retries=10,  # More connection retries (was 5)
-                retry_delay=3,  # Delay between retries (was 2s)
-                auto_reconnect=True,  # Auto-reconnect on disconnect
-                sequential_updates=True  # Process updates sequentially
-            )
-            await self.client.connect()
+            async with self._client_lock:
+                self._invalidate_auth_cache()
+                if self.client is not None and self.client.is_connected():
+                    # Drop the previous connection instead of leaking its socket
+                    await self.client.disconnect()
+                self.client = self._create_client()
+                await self.client.connect()
 
             if await self.client.is_user_authorized():
                 me = await self.client.get_me()
@@ -48,24 +84,13 @@ class TelegramService:
         """Disconnect from Telegram"""
         if self.client and self.client.is_connected():
             await self.client.disconnect()
+        self._entity_cache.clear()
+        self._invalidate_auth_cache()
 
     async def request_code(self):
         """Request verification code"""
-        if not self.client:
-            self.client = TelegramClient(
-                Config.SESSION_FILE,
-                Config.API_ID,
-                Config.API_HASH,
-                timeout=60,
-                request_retries=10,
-                connection_retries=10,
-                retry_delay=3,
-                auto_reconnect=True,
-                sequential_updates=True
-            )
-            await self.client.connect()
-
-        await self.client.send_code_request(Config.PHONE_NUMBER)
+        client = await self._ensure_client()
+        await client.send_code_request(Config.PHONE_NUMBER)
         return f"Verification code sent to {Config.PHONE_NUMBER}"
 
     async def verify_code(self, code: str):
@@ -74,6 +99,7 @@ class TelegramService:
             raise ValueError("Login not started. Call request_code first.")
 
         me = await self.client.sign_in(Config.PHONE_NUMBER, code)
+        self._invalidate_auth_cache()
         return {
             "id": me.id,
             "username": me.username,
@@ -86,6 +112,7 @@ class TelegramService:
             raise ValueError("Login not started.")
 
         me = await self.client.sign_in(password=password)
+        self._invalidate_auth_cache()
         return {
             "id": me.id,
             "username": me.username,
@@ -100,13 +127,35 @@ class TelegramService:
         """Check if user is authorized"""
         if not self.client:
             return False
-        return await self.client.is_user_authorized()
+
+        now = time.monotonic()
+        if self._authorized_cache and now - self._authorized_cache[0] < Config.AUTH_STATUS_CACHE_TTL:
+            return self._authorized_cache[1]
+
+        authorized = await self.client.is_user_authorized()
+        self._authorized_cache = (now, authorized)
+        return authorized
 
     async def get_me(self):
         """Get current user info"""
         if not self.client:
             return None
-        return await self.client.get_me()
+
+        now = time.monotonic()
+        if self._me_cache and now - self._me_cache[0] < Config.AUTH_STATUS_CACHE_TTL:
+            return self._me_cache[1]
+
+        me = await self.client.get_me()
+        self._me_cache = (now, me)
+        return me
+
+    async def resolve_entity(self, channel_username: str):
+        """Resolve a channel username to an input peer once and cache it"""
+        entity = self._entity_cache.get(channel_username)
+        if entity is None:
+            entity = await self.client.get_input_entity(channel_username)
+            self._entity_cache[channel_username] = entity
+        return entity
 
     async def get_channels(self):
         """Get list of channels and bots"""
@@ -127,10 +176,16 @@ class TelegramService:
                     "id": entity.id,
                     "username": f"@{entity.username}"
                 })
+            else:
+                continue
+
+            # Prime the entity cache so picking a listed chat needs no username lookup
+            if entity.username:
+                self._entity_cache[f"@{entity.username}"] = dialog.input_entity
 
         return bots + channels
 
-    async def list_files(
+    async def iter_files(
         self,
         channel_username: str,
         limit: int = 10,
@@ -141,9 +196,9 @@ class TelegramService:
         date_from: Optional[str] = None,
         date_to: Optional[str] = None,
         file_extension: Optional[str] = None
-    ) -> List[FileInfo]:
-        """List files from a channel with search and filter options"""
-        files = []
+    ) -> AsyncIterator[FileInfo]:
+        """Yield files from a channel matching the search and filter options"""
+        found = 0
 
         date_from_dt = None
         date_to_dt = None
@@ -159,33 +214,24 @@ class TelegramService:
             except:
                 logger.warning(f"Invalid date_to format: {date_to}")
 
-        async for message in self.client.iter_messages(channel_username, limit=limit * 2):
+        entity = await self.resolve_entity(channel_username)
+        async for message in self.client.iter_messages(entity, limit=limit * 2):
             if message.media:
+                media_info = extract_media_info(message)
+                if media_info is None:
+                    continue
+
+                file_name, file_type, file_size = media_info
                 file_info = None
 
-                if isinstance(message.media, MessageMediaDocument):
-                    doc = message.media.document
-                    file_name = next((attr.file_name for attr in doc.attributes
-                                      if hasattr(attr, 'file_name')), f"document_{message.id}")
-
-                    if not filter_type or filter_type == 'document':
-                        file_info = FileInfo(
-                            file_id=message.id,
-                            file_name=file_name,
-                            file_size=doc.size,
-                            file_type="document",
-                            date=str(message.date)
-                        )
-
-                elif isinstance(message.media, MessageMediaPhoto):
-                    if not filter_type or filter_type == 'photo':
-                        file_info = FileInfo(
-                            file_id=message.id,
-                            file_name=f"photo_{message.id}.jpg",
-                            file_size=0,
-                            file_type="photo",
-                            date=str(message.date)
-                        )
+                if not filter_type or filter_type == file_type:
+                    file_info = FileInfo(
+                        file_id=message.id,
+                        file_name=file_name,
+                        file_size=file_size,
+                        file_type=file_type,
+                        date=str(message.date)
+                    )
 
                 if file_info:
                     if search_query and search_query.lower() not in file_info.file_name.lower():
@@ -208,19 +254,42 @@ class TelegramService:
                         if ext != file_extension.lower().lstrip('.'):
                             continue
 
-                    files.append(file_info)
+                    yield file_info
+                    found += 1
 
-                    if len(files) >= limit:
+                    if found >= limit:
                         break
 
-        return files
+    async def list_files(
+        self,
+        channel_username: str,
+        limit: int = 10,
+        filter_type: Optional[str] = None,
+        search_query: Optional[str] = None,
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+        file_extension: Optional[str] = None
+    ) -> List[FileInfo]:
+        """List files from a channel with search and filter options"""
+        return [
+            file_info
+            async for file_info in self.iter_files(
+                channel_username, limit, filter_type, search_query, min_size,
+                max_size, date_from, date_to, file_extension
+            )
+        ]
 
     async def get_messages(self, channel_username: str, message_ids: List[int]):
         """Get specific messages by IDs"""
         messages_to_download = []
+        entity = await self.resolve_entity(channel_username)
 
-        for message_id in message_ids:
-            message = await self.client.get_messages(channel_username, ids=message_id)
+        # One batched request (Telethon splits it into 100-id chunks); results keep the ids order
+        messages = await self.client.get_messages(entity, ids=list(message_ids))
+
+        for message_id, message in zip(message_ids, messages):
             if message and message.media:
                 messages_to_download.append(message)
             else:
@@ -230,16 +299,16 @@ class TelegramService:
 
     async def get_message(self, channel_username: str, message_id: int):
         """Get a single message"""
-        return await self.client.get_messages(channel_username, ids=message_id)
+        entity = await self.resolve_entity(channel_username)
+        return await self.client.get_messages(entity, ids=message_id)
 
-    async def iter_messages(self, channel_username: str, limit: int):
-        """Iterate through channel messages"""
-        return self.client.iter_messages(channel_username, limit=limit)
+    async def iter_messages(self, channel_username: str, limit: Optional[int], **kwargs):
+        """Iterate through channel messages (extra kwargs such as offset_id/min_id go to Telethon)"""
+        entity = await self.resolve_entity(channel_username)
+        return self.client.iter_messages(entity, limit=limit, **kwargs)
 
     async def download_media(self, message, file_path: str, progress_callback=None):
         """Download media from message with optimized settings"""
-        import asyncio
-
         # Wrap progress callback to add small delay between updates
         last_callback_time = [datetime.now()]
 
@@ -252,9 +321,185 @@ class TelegramService:
                     progress_callback(current, total)
                     last_callback_time[0] = now
 
-        # Download with progress callback only (chunk size is handled by Telethon internally)
-        return await self.client.download_media(
-            message,
-            file=file_path,
-            progress_callback=throttled_progress_callback if progress_callback else None
-        )
+        # Large documents are fetched as several byte ranges in parallel
+        document = getattr(message.media, 'document', None)
+        if (Config.PARALLEL_DOWNLOAD_PARTS > 1 and document is not None
+                and document.size >= Config.PARALLEL_DOWNLOAD_MIN_SIZE
+                and os.path.isdir(file_path)):
+            result = await self._download_document_parallel(
+                message,
+                document,
+                file_path,
+                throttled_progress_callback if progress_callback else None
+            )
+        else:
+            # Download with progress callback only (chunk size is handled by Telethon internally)
+            result = await self.client.download_media(
+                message,
+                file=file_path,
+                progress_callback=throttled_progress_callback if progress_callback else None
+            )
+
+        if (result and document is not None and Config.DROP_PAGE_CACHE_MIN_SIZE
+                and document.size >= Config.DROP_PAGE_CACHE_MIN_SIZE):
+            await asyncio.to_thread(self._drop_page_cache, result)
+        return result
+
+    @staticmethod
+    def _drop_page_cache(path: str):
+        """Flush a finished file and advise the kernel to drop its cached pages"""
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                # Dirty pages can't be evicted, so write them back first
+                os.fdatasync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.debug("Could not drop page cache for %s: %s", path, e)
+
+    @staticmethod
+    def _publish_part_file(part_path: str, directory: str, file_name: str) -> str:
+        """Move a finished part file into directory under a name no other file has (blocking)
+
+        Linking fails instead of overwriting when the name is taken, so two downloads
+        finishing with the same name at once can't replace each other.
+        """
+        base, ext = os.path.splitext(file_name)
+        path = os.path.join(directory, file_name)
+        counter = 1
+        while True:
+            try:
+                os.link(part_path, path)
+                break
+            except FileExistsError:
+                path = os.path.join(directory, f"{base} ({counter}){ext}")
+                counter += 1
+        os.remove(part_path)
+        return path
+
+    @staticmethod
+    def partial_path(message) -> Optional[str]:
+        """Path a parallel download of this message is written to before it is complete"""
+        document = getattr(message.media, 'document', None)
+        if document is None:
+            return None
+        return os.path.join(Config.PARTIAL_PATH, f"{message.id}_{document.id}.part")
+
+    @staticmethod
+    def clear_partial_downloads():
+        """Remove part files left behind by a crash (call before any download starts)"""
+        try:
+            with os.scandir(Config.PARTIAL_PATH) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.part'):
+                        os.remove(entry.path)
+                        logger.info("Removed stale partial download %s", entry.name)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error("Error clearing partial downloads: %s", e)
+
+    @staticmethod
+    def _open_part_file(part_path: str, size: int) -> int:
+        """Create the part file with the full size reserved so ranges can be written in any order"""
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, size)
+        return fd
+
+    @staticmethod
+    def _discard_part_file(part_path: str):
+        """Remove an unfinished part file"""
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    async def _close_after_writes(fd: int, pending_writes: set):
+        """Close fd once every write still running in a worker thread has finished
+
+        Closing earlier would let the descriptor number be reused by the next open()
+        in the process, and a late write would then land in that unrelated file.
+        """
+        if not pending_writes:
+            os.close(fd)
+            return
+        writes = asyncio.gather(*pending_writes, return_exceptions=True)
+        # The close hangs off the writes themselves, so it still happens if we are cancelled again
+        writes.add_done_callback(lambda _: os.close(fd))
+        await asyncio.shield(writes)
+
+    async def _download_document_parallel(self, message, document, target_dir: str, progress_callback=None) -> str:
+        """Download a document as PARALLEL_DOWNLOAD_PARTS byte ranges written into a preallocated file"""
+        file_name = os.path.basename(extract_media_info(message)[0])
+        if not os.path.splitext(file_name)[1]:
+            file_name += utils.get_extension(document)
+
+        size = document.size
+        chunk_size = Config.DOWNLOAD_CHUNK_SIZE
+        total_chunks = -(-size // chunk_size)
+        chunks_per_part = -(-total_chunks // min(Config.PARALLEL_DOWNLOAD_PARTS, total_chunks))
+        downloaded = 0
+
+        # Outside the listed download directory so half-written files are never served
+        part_path = self.partial_path(message)
+        fd = await asyncio.to_thread(self._open_part_file, part_path, size)
+        pending_writes = set()
+        completed = False
+        try:
+            async def fetch_range(first_chunk: int, chunk_count: int):
+                nonlocal downloaded
+                position = first_chunk * chunk_size
+                async for chunk in self.client.iter_download(
+                    document,
+                    offset=position,
+                    limit=chunk_count,
+                    request_size=chunk_size,
+                    file_size=size
+                ):
+                    # Disk writes go to a worker thread like the rest of the blocking I/O. Cancelling
+                    # the range can't stop a write already in the thread, so it is shielded and
+                    # tracked until it finishes, and the fd stays open until then
+                    write = asyncio.ensure_future(asyncio.to_thread(os.pwrite, fd, chunk, position))
+                    pending_writes.add(write)
+                    write.add_done_callback(pending_writes.discard)
+                    await asyncio.shield(write)
+                    position += len(chunk)
+                    downloaded += len(chunk)
+                    if progress_callback:
+                        progress_callback(downloaded, size)
+
+            tasks = [
+                asyncio.create_task(fetch_range(first, min(chunks_per_part, total_chunks - first)))
+                for first in range(0, total_chunks, chunks_per_part)
+            ]
+            logger.info("Downloading %s (%s bytes) in %s parallel parts", file_name, size, len(tasks))
+
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # One range failed (or we were cancelled): stop the others too
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+
+            os.close(fd)
+            fd = None
+            final_path = await asyncio.to_thread(self._publish_part_file, part_path, target_dir, file_name)
+            completed = True
+            return final_path
+        finally:
+            # Unlinking first is safe with writes still in flight; they go to the orphaned inode
+            if not completed:
+                self._discard_part_file(part_path)
+            if fd is not None:
+                await self._close_after_writes(fd, pending_writes)
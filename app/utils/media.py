@@ -0,0 +1,51 @@
+from typing import Optional, Tuple
+from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto
+
+
+def _from_document(message) -> Tuple[str, str, int]:
+    """Extract (file_name, file_type, size) from a document message"""
+    doc = message.media.document
+    for attr in doc.attributes:
+        file_name = getattr(attr, 'file_name', None)
+        if file_name:
+            return file_name, "document", doc.size
+    return f"document_{message.id}", "document", doc.size
+
+
+def _from_photo(message) -> Tuple[str, str, int]:
+    """Extract (file_name, file_type, size) from a photo message"""
+    return f"photo_{message.id}.jpg", "photo", 0
+
+
+# Dispatch on the exact media type instead of an isinstance chain
+_EXTRACTORS = {
+    MessageMediaDocument: _from_document,
+    MessageMediaPhoto: _from_photo,
+}
+
+
+# Attribute used to memoize the extracted info on the message object
+_CACHE_ATTR = "_telefetchr_media_info"
+_MISSING = object()
+
+
+def extract_media_info(message) -> Optional[Tuple[str, str, int]]:
+    """Return (file_name, file_type, size) for downloadable media, or None
+
+    The result is computed once and cached on the message, so the listing,
+    filtering and download paths all share a single attribute scan.
+    """
+    media_info = getattr(message, _CACHE_ATTR, _MISSING)
+    if media_info is not _MISSING:
+        return media_info
+
+    extractor = _EXTRACTORS.get(type(message.media))
+    media_info = extractor(message) if extractor is not None else None
+    setattr(message, _CACHE_ATTR, media_info)
+    return media_info
+
+
+def extract_file_name(message) -> str:
+    """Return the file name for a message's media"""
+    media_info = extract_media_info(message)
+    return media_info[0] if media_info else "unknown"
@@ -1,80 +1,278 @@
-import json
 import os
 import logging
+import orjson
+from dataclasses import dataclass
+from types import MappingProxyType
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import uuid
+import time
 import asyncio
+import threading
 
 from app.config import Config
 
 logger = logging.getLogger(__name__)
 
 
+# Scalar fields of a fresh download status; the per-file dicts and session id are added per instance
+_DEFAULT_STATE = MappingProxyType({
+    "active": False,
+    "progress": 0,
+    "total": 0,
+    "current_file": "",
+    "current_file_progress": 0,
+    "current_file_size": 0,
+    "downloaded_bytes": 0,
+    "cancelled": False,
+    "started_at": None,
+    "channel": None,
+    "resume_offset_id": None,
+    "window_min_id": None
+})
+
+
+@dataclass(slots=True)
+class DownloadEntry:
+    """Live progress of a file that is currently downloading"""
+    name: str
+    progress: int = 0
+    total: int = 0
+    retry_attempt: Optional[int] = None
+    last_update: Optional[str] = None
+
+    @property
+    def percentage(self) -> int:
+        """Derived on read so progress ticks only store raw byte counts"""
+        return (self.progress * 100) // self.total if self.total > 0 else 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serializable view including the derived percentage"""
+        return {
+            "name": self.name,
+            "progress": self.progress,
+            "total": self.total,
+            "percentage": self.percentage,
+            "retry_attempt": self.retry_attempt,
+            "last_update": self.last_update
+        }
+
+
 class StateManager:
     """Manages download state persistence"""
 
     def __init__(self):
         self.state_file = Config.STATE_FILE
+        self.completed_log = Config.COMPLETED_LOG
         self.download_status = self._initialize_status()
+        self.downloaded_files = set()
         self._lock = asyncio.Lock()
+        # File writes run in worker threads; the state file and the journal are
+        # independent, so each has its own lock and one never waits on the other's fsync
+        self._state_file_lock = threading.Lock()
+        self._journal_lock = threading.Lock()
+        self._last_save_ts = 0.0
+        self._state_dirty: Optional[asyncio.Event] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._writer_stopping = False
+        # Bumped on every status change so pollers can revalidate cheaply; the
+        # per-process prefix keeps ETags from a previous run from matching
+        self.state_version = 0
+        self._etag_prefix = uuid.uuid4().hex[:8]
 
     def _initialize_status(self) -> Dict[str, Any]:
         """Initialize default download status"""
         return {
-            "active": False,
-            "progress": 0,
-            "total": 0,
-            "current_file": "",
-            "current_file_progress": 0,
-            "current_file_size": 0,
-            "downloaded_bytes": 0,
+            **_DEFAULT_STATE,
             "concurrent_downloads": {},
             "completed_downloads": {},
-            "cancelled": False,
-            "session_id": str(uuid.uuid4()),
-            "started_at": None,
-            "channel": None
+            # Kept equal to len(completed_downloads) by the completed-download helpers
+            "completed_count": 0,
+            "session_id": uuid.uuid4().hex
         }
 
-    def save_state(self):
-        """Save current download state to file"""
+    async def start_session(self, channel: str, total: int = 0) -> str:
+        """Reset the status for a new download session and return its id"""
+        session_id = uuid.uuid4().hex
+        await self.clear_completed()
+        self.clear_concurrent()
+        self.download_status.update(_DEFAULT_STATE)
+        self.download_status["active"] = True
+        self.download_status["total"] = total
+        self.download_status["session_id"] = session_id
+        self.download_status["started_at"] = datetime.now().isoformat()
+        self.download_status["channel"] = channel
+        self.save_state()
+        return session_id
+
+    def _mark_changed(self):
+        """Bump the status version; every mutation the ETag depends on goes through here"""
+        self.state_version += 1
+
+    def _reset_status(self):
+        """Replace the whole status with a fresh default one"""
+        self.download_status.update(self._initialize_status())
+        self._mark_changed()
+
+    def _snapshot(self) -> Dict[str, Any]:
+        """Copy the persisted subset of the download status"""
+        return {
+            "active": self.download_status.get("active", False),
+            "progress": self.download_status.get("progress", 0),
+            "total": self.download_status.get("total", 0),
+            "current_file": self.download_status.get("current_file", ""),
+            "current_file_progress": self.download_status.get("current_file_progress", 0),
+            "current_file_size": self.download_status.get("current_file_size", 0),
+            "downloaded_bytes": self.download_status.get("downloaded_bytes", 0),
+            # completed_downloads is persisted separately in the append-only journal
+            "cancelled": self.download_status.get("cancelled", False),
+            "session_id": self.download_status.get("session_id"),
+            "started_at": self.download_status.get("started_at"),
+            "channel": self.download_status.get("channel"),
+            # Message id window left to scan when a download-all session is resumed
+            "resume_offset_id": self.download_status.get("resume_offset_id"),
+            "window_min_id": self.download_status.get("window_min_id")
+        }
+
+    @staticmethod
+    def _fsync_dir(directory: str):
+        """Flush a directory entry so a completed rename survives a crash"""
+        dir_fd = os.open(directory, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
         try:
-            os.makedirs(Config.SESSION_DIR, exist_ok=True)
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
-            # Create a copy to save
-            state_to_save = {
-                "active": self.download_status.get("active", False),
-                "progress": self.download_status.get("progress", 0),
-                "total": self.download_status.get("total", 0),
-                "current_file": self.download_status.get("current_file", ""),
-                "current_file_progress": self.download_status.get("current_file_progress", 0),
-                "current_file_size": self.download_status.get("current_file_size", 0),
-                "downloaded_bytes": self.download_status.get("downloaded_bytes", 0),
-                "completed_downloads": self.download_status.get("completed_downloads", {}),
-                "cancelled": self.download_status.get("cancelled", False),
-                "session_id": self.download_status.get("session_id"),
-                "started_at": self.download_status.get("started_at"),
-                "channel": self.download_status.get("channel")
-            }
+    def _write_snapshot(self, state_to_save: Dict[str, Any]):
+        """Write a state snapshot to file (blocking)"""
+        try:
+            os.makedirs(Config.SESSION_DIR, exist_ok=True)
 
             # Write to temp file first, then rename (atomic operation)
+            payload = orjson.dumps(state_to_save, option=orjson.OPT_NON_STR_KEYS, default=str)
             temp_file = self.state_file + '.tmp'
-            with open(temp_file, 'w') as f:
-                json.dump(state_to_save, f, default=str, indent=2)
+            with self._state_file_lock:
+                with open(temp_file, 'wb') as f:
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                # Atomic rename, then persist the rename itself
+                os.replace(temp_file, self.state_file)
+                self._fsync_dir(Config.SESSION_DIR)
+
+        except Exception as e:
+            logger.error("Error saving state: %s", e)
+
+    def save_state(self):
+        """Save current download state to file
+
+        Once the background writer is running this only marks the state dirty;
+        the writer coalesces pending saves and writes off the event loop.
+        """
+        self._mark_changed()
+        self._last_save_ts = time.monotonic()
+        if self._writer_task and not self._writer_task.done():
+            self._state_dirty.set()
+        else:
+            self._write_snapshot(self._snapshot())
+
+    async def _state_writer(self):
+        """Background task that persists the latest state whenever it is marked dirty"""
+        while True:
+            await self._state_dirty.wait()
+            if self._writer_stopping:
+                return
+            self._state_dirty.clear()
+            # Snapshot on the loop so the worker thread never sees a dict mid-mutation
+            snapshot = self._snapshot()
+            await asyncio.to_thread(self._write_snapshot, snapshot)
+
+    def start_writer(self):
+        """Start the background state writer (requires a running event loop)"""
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_stopping = False
+            self._state_dirty = asyncio.Event()
+            self._writer_task = asyncio.create_task(self._state_writer())
+
+    async def stop_writer(self):
+        """Stop the background writer and flush the current state synchronously"""
+        if self._writer_task:
+            # Let an in-flight write finish instead of cancelling it mid-rename
+            self._writer_stopping = True
+            self._state_dirty.set()
+            await self._writer_task
+            self._writer_task = None
+        self._write_snapshot(self._snapshot())
+
+    @staticmethod
+    def _encode_record(file_id: str, file_data: Dict[str, Any]) -> bytes:
+        """Serialize one completed record as a journal line"""
+        return orjson.dumps({"file_id": file_id, **file_data}, default=str) + b'\n'
+
+    def _append_completed(self, payload: bytes):
+        """Append encoded completed records to the journal with a single fsync (blocking)"""
+        try:
+            with self._journal_lock, open(self.completed_log, 'ab') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            logger.error("Error appending completed downloads: %s", e)
 
-            # Atomic rename
-            os.replace(temp_file, self.state_file)
+    def _encode_completed(self) -> bytes:
+        """Serialize the in-memory completed downloads as journal lines (run on the loop)"""
+        return b''.join(
+            self._encode_record(file_id, file_data)
+            for file_id, file_data in self.download_status.get("completed_downloads", {}).items()
+        )
 
+    def _rewrite_completed_log(self, payload: bytes):
+        """Replace the journal with already encoded records (blocking)"""
+        try:
+            temp_file = self.completed_log + '.tmp'
+            with self._journal_lock:
+                with open(temp_file, 'wb') as f:
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_file, self.completed_log)
+                self._fsync_dir(Config.SESSION_DIR)
         except Exception as e:
-            logger.error(f"Error saving state: {e}")
+            logger.error("Error rewriting completed downloads: %s", e)
+
+    def _load_completed_log(self) -> Dict[str, Dict[str, Any]]:
+        """Replay the journal into a completed downloads dict"""
+        completed = {}
+        if not os.path.exists(self.completed_log):
+            return completed
+
+        with open(self.completed_log, 'rb') as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # A torn trailing line from a crash mid-append
+                    logger.warning("Skipping unreadable line in completed downloads journal")
+                    continue
+                file_id = record.pop("file_id", None)
+                if file_id:
+                    completed[file_id] = record
+        return completed
+
+    def maybe_save_state(self, force: bool = False):
+        """Save state at most once per STATE_SAVE_INTERVAL unless forced"""
+        # Progress changed even when the write itself is throttled
+        self._mark_changed()
+        if force or time.monotonic() - self._last_save_ts > Config.STATE_SAVE_INTERVAL:
+            self.save_state()
 
     def load_state(self):
         """Load download state from file"""
         try:
             if os.path.exists(self.state_file):
-                with open(self.state_file, 'r') as f:
-                    saved_state = json.load(f)
+                with open(self.state_file, 'rb') as f:
+                    saved_state = orjson.loads(f.read())
 
                     # Only restore if the state is meaningful
                     if saved_state.get("session_id") and saved_state.get("channel"):
@@ -84,21 +282,35 @@ class StateManager:
                             saved_state["cancelled"] = True
                             logger.info("Found interrupted download session - marked for resume")
 
+                        # State files from older versions embed completed downloads;
+                        # migrate them into the journal once
+                        legacy_completed = saved_state.pop("completed_downloads", None)
+
                         # Merge with current status
                         self.download_status.update(saved_state)
 
+                        if legacy_completed:
+                            self.download_status["completed_downloads"] = legacy_completed
+                        else:
+                            self.download_status["completed_downloads"] = self._load_completed_log()
+                        self.download_status["completed_count"] = len(self.download_status["completed_downloads"])
+
+                        # Compact the journal once per start (also drops any torn trailing line
+                        # so later appends start on a clean line)
+                        self._rewrite_completed_log(self._encode_completed())
+
                         # Clear concurrent downloads (they're not valid after restart)
-                        self.download_status["concurrent_downloads"] = {}
+                        self.clear_concurrent()
 
-                        logger.info(f"Loaded saved download state: {len(saved_state.get('completed_downloads', {}))} completed files")
+                        logger.info("Loaded saved download state: %s completed files", self.download_status['completed_count'])
                     else:
                         logger.info("No valid saved state found")
 
-        except json.JSONDecodeError as e:
-            logger.error(f"Corrupted state file: {e}")
+        except orjson.JSONDecodeError as e:
+            logger.error("Corrupted state file: %s", e)
             self._backup_corrupted_state()
         except Exception as e:
-            logger.error(f"Error loading state: {e}")
+            logger.error("Error loading state: %s", e)
 
     def _backup_corrupted_state(self):
         """Backup corrupted state file"""
@@ -106,24 +318,36 @@ class StateManager:
             if os.path.exists(self.state_file):
                 backup_file = self.state_file + '.corrupted.' + str(int(datetime.now().timestamp()))
                 os.rename(self.state_file, backup_file)
-                logger.info(f"Backed up corrupted state to {backup_file}")
+                logger.info("Backed up corrupted state to %s", backup_file)
         except Exception as e:
-            logger.error(f"Failed to backup corrupted state: {e}")
+            logger.error("Failed to backup corrupted state: %s", e)
 
-    def clear_state(self):
-        """Clear saved state file"""
-        try:
+    def _backup_state_files(self):
+        """Move the state file and the journal aside before a reset (blocking)"""
+        timestamp = str(int(datetime.now().timestamp()))
+        with self._state_file_lock:
             if os.path.exists(self.state_file):
-                # Backup before clearing
-                backup_file = self.state_file + '.backup.' + str(int(datetime.now().timestamp()))
+                backup_file = self.state_file + '.backup.' + timestamp
                 os.rename(self.state_file, backup_file)
-                logger.info(f"Backed up state to {backup_file} before clearing")
+                logger.info("Backed up state to %s before clearing", backup_file)
 
-            # Reset global state
-            self.download_status.update(self._initialize_status())
+        with self._journal_lock:
+            if os.path.exists(self.completed_log):
+                os.rename(self.completed_log, self.completed_log + '.backup.' + timestamp)
 
-        except Exception as e:
-            logger.error(f"Error clearing state: {e}")
+    async def clear_state(self):
+        """Clear saved state file"""
+        # Same locking as clear_completed, so an in-flight append can't recreate the
+        # journal with a record from the session being cleared
+        async with self._lock:
+            try:
+                await asyncio.to_thread(self._backup_state_files)
+
+                # Reset global state
+                self._reset_status()
+
+            except Exception as e:
+                logger.error("Error clearing state: %s", e)
 
     def cleanup_state(self):
         """Clean up corrupted or incomplete state"""
@@ -133,16 +357,16 @@ class StateManager:
             try:
                 import shutil
                 shutil.copy2(self.state_file, backup_file)
-                logger.info(f"Backed up state to {backup_file}")
+                logger.info("Backed up state to %s", backup_file)
             except Exception as e:
-                logger.error(f"Failed to backup state: {e}")
+                logger.error("Failed to backup state: %s", e)
 
         # Clean up incomplete downloads
         cleaned_items = []
         if not self.download_status.get("active") and self.download_status.get("concurrent_downloads"):
             cleaned_items = list(self.download_status["concurrent_downloads"].keys())
-            self.download_status["concurrent_downloads"] = {}
-            logger.info(f"Cleaned up {len(cleaned_items)} incomplete downloads")
+            self.clear_concurrent()
+            logger.info("Cleaned up %s incomplete downloads", len(cleaned_items))
 
         # Reset fields that don't make sense when not active
         if not self.download_status.get("active"):
@@ -153,12 +377,29 @@ class StateManager:
 
         # If there are no completed downloads and no channel, reset everything
         if not self.download_status.get("completed_downloads") and not self.download_status.get("channel"):
-            self.download_status.update(self._initialize_status())
+            self._reset_status()
             logger.info("Reset state completely (no valid session data)")
 
         self.save_state()
         return cleaned_items
 
+    def index_downloaded_files(self):
+        """Rebuild the set of downloaded file names with a single directory scan"""
+        try:
+            with os.scandir(Config.SAVE_PATH) as entries:
+                self.downloaded_files = {entry.name for entry in entries if entry.is_file()}
+            logger.info("Indexed %s downloaded files", len(self.downloaded_files))
+        except Exception as e:
+            logger.error("Error indexing downloaded files: %s", e)
+
+    def is_downloaded_file(self, filename: str) -> bool:
+        """Check whether a file name is known to exist in the download directory"""
+        return filename in self.downloaded_files
+
+    def etag(self) -> str:
+        """Entity tag identifying the current status version"""
+        return f'"{self._etag_prefix}-{self.state_version}"'
+
     def get_status(self) -> Dict[str, Any]:
         """Get current download status"""
         return self.download_status
@@ -168,20 +409,98 @@ class StateManager:
         self.download_status.update(updates)
         self.save_state()
 
+    def track_download(self, file_id: str, entry: DownloadEntry):
+        """Register a file that has started downloading"""
+        self._mark_changed()
+        self.download_status["concurrent_downloads"][file_id] = entry
+
+    def untrack_download(self, file_id: str) -> Optional[DownloadEntry]:
+        """Remove a file from the in-flight downloads, returning its entry if present"""
+        self._mark_changed()
+        return self.download_status["concurrent_downloads"].pop(file_id, None)
+
+    def clear_concurrent(self):
+        """Forget all in-flight downloads"""
+        self._mark_changed()
+        self.download_status["concurrent_downloads"].clear()
+
     async def mark_file_completed(self, file_id: str, file_data: Dict[str, Any]):
         """Thread-safe method to mark a file as completed and update progress"""
         async with self._lock:
-            # Add to completed downloads
-            self.download_status["completed_downloads"][file_id] = file_data
+            # Add to completed downloads and journal it; the fsync'd append runs off the loop
+            completed_downloads = self.download_status["completed_downloads"]
+            if file_id not in completed_downloads:
+                self.download_status["completed_count"] += 1
+            completed_downloads[file_id] = file_data
+            self._mark_changed()
+            await asyncio.to_thread(self._append_completed, self._encode_record(file_id, file_data))
+            if file_data.get("path"):
+                self.downloaded_files.add(os.path.basename(file_data["path"]))
 
             # Remove from concurrent downloads if present
-            if file_id in self.download_status.get("concurrent_downloads", {}):
-                del self.download_status["concurrent_downloads"][file_id]
+            self.untrack_download(file_id)
 
             # Update progress based on current completed count
-            self.download_status["progress"] = len(self.download_status["completed_downloads"])
+            self.download_status["progress"] = self.download_status["completed_count"]
 
             # Save the state
             self.save_state()
 
-            logger.info(f"File {file_id} marked as completed. Progress: {self.download_status['progress']}/{self.download_status.get('total', 0)}")
+            logger.info("File %s marked as completed. Progress: %s/%s", file_id, self.download_status['progress'], self.download_status.get('total', 0))
+
+    async def mark_files_completed(self, completed: Dict[str, Dict[str, Any]]):
+        """Mark many files as completed with one journal append and one save"""
+        if not completed:
+            return
+        async with self._lock:
+            completed_downloads = self.download_status["completed_downloads"]
+            for file_id, file_data in completed.items():
+                if file_id not in completed_downloads:
+                    self.download_status["completed_count"] += 1
+                completed_downloads[file_id] = file_data
+                if file_data.get("path"):
+                    self.downloaded_files.add(os.path.basename(file_data["path"]))
+                self.untrack_download(file_id)
+            self._mark_changed()
+            payload = b''.join(self._encode_record(file_id, file_data) for file_id, file_data in completed.items())
+            await asyncio.to_thread(self._append_completed, payload)
+
+            self.download_status["progress"] = self.download_status["completed_count"]
+            self.save_state()
+
+            logger.info("Marked %s files as completed. Progress: %s/%s", len(completed), self.download_status['progress'], self.download_status.get('total', 0))
+
+    async def remove_completed(self, file_id: str) -> bool:
+        """Remove a single completed download; returns False if it was not found"""
+        async with self._lock:
+            completed_downloads = self.download_status.get("completed_downloads", {})
+            if file_id not in completed_downloads:
+                return False
+
+            del completed_downloads[file_id]
+            self.download_status["completed_count"] -= 1
+            self.download_status["progress"] = self.download_status["completed_count"]
+            self._mark_changed()
+            # Encode on the loop, then rewrite and fsync in a worker thread
+            await asyncio.to_thread(self._rewrite_completed_log, self._encode_completed())
+            self.save_state()
+            return True
+
+    def _remove_completed_log(self):
+        """Delete the journal file (blocking)"""
+        try:
+            with self._journal_lock:
+                if os.path.exists(self.completed_log):
+                    os.remove(self.completed_log)
+        except Exception as e:
+            logger.error("Error clearing completed downloads journal: %s", e)
+
+    async def clear_completed(self):
+        """Forget all completed downloads and truncate the journal"""
+        # Holding the state lock waits out an in-flight append from mark_file_completed,
+        # which would otherwise recreate the journal with a record that was just cleared
+        async with self._lock:
+            self.download_status["completed_downloads"] = {}
+            self.download_status["completed_count"] = 0
+            self._mark_changed()
+            await asyncio.to_thread(self._remove_completed_log)
@@ -3,6 +3,7 @@ from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+import asyncio
 import logging
 
 from app.config import Config
@@ -11,7 +12,7 @@ from app.services.download_service import DownloadService
 from app.services.auth_service import AuthService
 from app.utils.state_manager import StateManager
 from app.utils.auth_dependencies import set_auth_service
-from app.api.routes import router, set_services
+from app.api.routes import router, set_services, load_pages
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -33,6 +34,11 @@ async def lifespan(app: FastAPI):
     try:
         # Ensure required directories exist
         Config.ensure_directories()
+        # No download can be running yet, so any part file is an orphan from a crash
+        TelegramService.clear_partial_downloads()
+
+        # Cache the HTML pages in memory
+        load_pages()
 
         # Initialize authentication service
         auth_service = AuthService()
@@ -41,7 +47,10 @@ async def lifespan(app: FastAPI):
 
         # Initialize state manager and load saved state
         state_manager = StateManager()
-        state_manager.load_state()
+        # Loading replays and compacts the journal with fsyncs; keep that off the loop
+        await asyncio.to_thread(state_manager.load_state)
+        state_manager.index_downloaded_files()
+        state_manager.start_writer()
 
         # Initialize Telegram service
         telegram_service = TelegramService()
@@ -70,13 +79,13 @@ async def lifespan(app: FastAPI):
 
     yield
 
-    # Shutdown - save state one final time
-    if state_manager:
-        state_manager.save_state()
-
-    # Cancel any active download tasks
+    # Shutdown - cancel active download tasks and wait for them to unwind
     if download_service:
-        download_service.cleanup_tasks()
+        await download_service.cleanup_tasks()
+
+    # Stop the background writer and save state one final time
+    if state_manager:
+        await state_manager.stop_writer()
 
     # Disconnect Telegram client
     if telegram_service:
@@ -105,4 +114,6 @@ app.include_router(router)
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host=Config.HOST, port=Config.PORT)
+    # uvloop and httptools ship with uvicorn[standard]; select them explicitly so a
+    # broken install fails loudly instead of silently falling back to asyncio/h11
+    uvicorn.run(app, host=Config.HOST, port=Config.PORT, loop="uvloop", http="httptools")